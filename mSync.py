@@ -29,10 +29,17 @@ mSync: A tool to recursively synchronize data between a local directory and a Mi
 
 import os
 import sys
+import time
+import json
 import hashlib
 import getopt
 import shutil
+import datetime
 import pprint
+import Queue
+import threading
+import subprocess
+import collections
 import pydas
 
 class SyncStatusDict(object):
@@ -43,21 +50,50 @@ class SyncStatusDict(object):
         self.only_local = {'entire_dirs': [ ], 'files': [ ] }
         self.only_midas = {'entire_folders': [ ], 'items': [ ]}
         self.needs_update = {'files': [ ] }
+        # local only resources with the same name and content as Midas only ones,
+        # and the Midas folders to create for the items moved into new directories
+        self.moves = {'folders': [ ], 'items': [ ], 'new_folders': [ ]}
+        # lookup table: Midas item id -> size in bytes, used to plan downloads
+        self.midas_item_sizes = { }
+        # lookup table: local only directory -> Midas folder id of its parent
+        self.midas_parent_folder_ids = { }
         
     def is_empty(self):
         if self.only_local['entire_dirs'] or self.only_local['files'] \
             or self.only_midas['entire_folders'] or self.only_midas['items'] \
-            or self.needs_update['files']:
+            or self.needs_update['files'] \
+            or self.moves['folders'] or self.moves['items']:
             return False
         else:
             return True
 
+    def to_dict(self):
+        return {"only_local" : self.only_local,
+                "only_midas" : self.only_midas,
+                "needs_update" : self.needs_update,
+                "moves" : self.moves,
+                "midas_item_sizes" : self.midas_item_sizes,
+                "midas_parent_folder_ids" : self.midas_parent_folder_ids}
+
+    @classmethod
+    def from_dict(cls, status_dict):
+        sync_status = cls()
+        sync_status.only_local = status_dict['only_local']
+        sync_status.only_midas = status_dict['only_midas']
+        sync_status.needs_update = status_dict['needs_update']
+        sync_status.moves = status_dict['moves']
+        sync_status.moves.setdefault('new_folders', [ ])
+        sync_status.midas_item_sizes = status_dict['midas_item_sizes']
+        sync_status.midas_parent_folder_ids = status_dict['midas_parent_folder_ids']
+        return sync_status
+
     def pprint(self):
         pp = pprint.PrettyPrinter(indent = 2)
         print ("The current synchronization information is as below: ")
         pp.pprint({"only_local" : self.only_local,
                    "only_midas" : self.only_midas,
-                   "needs_update" : self.needs_update})
+                   "needs_update" : self.needs_update,
+                   "moves" : self.moves})
 
         
 class SyncSetting(object):
@@ -65,20 +101,516 @@ class SyncSetting(object):
     Class for synchronization setting
     """
     def __init__(self, mode, local_root_dir, midas_url, midas_apikey, 
-                 midas_user_email, midas_root_folder_id):
+                 midas_user_email, midas_root_folder_id, stats_interval=10,
+                 journal_file=None, shard=None, shard_by='topdir', report_file=None,
+                 reuse=None, large_file_size=1024 * 1024 * 1024, large_lanes=2,
+                 small_lanes=8, rescan=False):
         self.mode = mode
         self.local_root_dir = local_root_dir
         self.midas_url = midas_url
         self.midas_apikey = midas_apikey
         self.midas_user_email = midas_user_email
         self.midas_root_folder_id = midas_root_folder_id
+        self.stats_interval = stats_interval
+        self.journal_file = journal_file
+        # discard the plan of an interrupted run and check the status again
+        self.rescan = rescan
+        # shard is None or (shard_index, shard_count)
+        self.shard = shard
+        self.shard_by = shard_by
+        self.report_file = report_file
+        # how to reuse local copies when downloading: None, copy, hardlink or reflink
+        self.reuse = reuse
+        # transfer scheduler: files of at least large_file_size bytes use the
+        # large lanes, the other files use the small lanes
+        self.large_file_size = large_file_size
+        self.large_lanes = large_lanes
+        self.small_lanes = small_lanes
+
+
+class SyncJournal(object):
+    """
+    Class for the append-only journal of an upload or download. The plan
+    (the synchronization status) is written first, followed by one record
+    per completed operation, so that an interrupted run can be resumed
+    without checking the synchronization status again.
+    """
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.journal = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        records = []
+        if self.journal_file is None or not os.path.isfile(self.journal_file):
+            return records
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # the last record may be truncated if the run was killed
+                    break
+        return records
+
+    def start(self, mode, sync_status):
+        journal_dir = os.path.dirname(self.journal_file)
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        self.journal = open(self.journal_file, 'w')
+        self.record('plan', mode=mode, sync_status=sync_status.to_dict())
+
+    def resume(self):
+        self.journal = open(self.journal_file, 'a')
+
+    def record(self, op, **kwargs):
+        kwargs['op'] = op
+        with self.lock:
+            self.journal.write(json.dumps(kwargs) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def finish(self):
+        self.journal.close()
+        os.remove(self.journal_file)
+
+    def discard(self):
+        if os.path.isfile(self.journal_file):
+            os.remove(self.journal_file)
+
+
+class LocalContentIndex(object):
+    """
+    Class for an index of the local files by size and md5 checksum, used to
+    satisfy downloads with a local copy of the same content. A file is only
+    hashed once an item of the same size is wanted, and hashed again if it
+    was modified since.
+    """
+    def __init__(self, local_root_dir, reuse, progress):
+        self.reuse = reuse
+        self.progress = progress
+        self.lock = threading.RLock()
+        # size -> [local file paths],
+        # local file path -> (size, modification time, md5 checksum)
+        self.paths_by_size = { }
+        self.checksums = { }
+        for root, dirs, files in os.walk(local_root_dir, topdown=True):
+            # ignore hidden directories
+            dirs[:] = [d for d in dirs if not d[0] == '.']
+            for filename in files:
+                local_file_path = os.path.join(root, filename)
+                if os.path.isfile(local_file_path) and not os.path.islink(local_file_path):
+                    self.add(local_file_path)
+
+    def add(self, local_file_path, checksum=None):
+        stat = os.stat(local_file_path)
+        with self.lock:
+            self.paths_by_size.setdefault(stat.st_size, []).append(local_file_path)
+            if checksum is not None:
+                self.checksums[local_file_path] = (stat.st_size, stat.st_mtime, checksum)
+
+    def find(self, size, checksum):
+        with self.lock:
+            local_file_paths = list(self.paths_by_size.get(size, [ ]))
+        for local_file_path in local_file_paths:
+            # the file may have been removed or overwritten since it was indexed
+            if not os.path.isfile(local_file_path):
+                continue
+            stat = os.stat(local_file_path)
+            if stat.st_size != size:
+                continue
+            with self.lock:
+                cached = self.checksums.get(local_file_path)
+            if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+                local_file_checksum = cached[2]
+            else:
+                hash_started = time.time()
+                local_file_checksum = _md5_for_file(local_file_path)
+                self.progress.file_hashed(size, time.time() - hash_started)
+                with self.lock:
+                    self.checksums[local_file_path] = (stat.st_size, stat.st_mtime,
+                                                       local_file_checksum)
+            if local_file_checksum == checksum:
+                return local_file_path
+        return None
+
+    def reuse_for_item(self, midas_item_info, local_dir_path):
+        """
+        Create the file of a Midas item in local_dir_path from a local file
+        with the same content. Return the number of bytes reused, 0 if there
+        is no such file.
+        """
+        # assumption: each item only contains one bitstream
+        if not midas_item_info['revisions'] \
+            or not midas_item_info['revisions'][-1]['bitstreams']:
+            return 0
+        bitstream = midas_item_info['revisions'][-1]['bitstreams'][0]
+        size = bitstream.get('size', midas_item_info.get('sizebytes'))
+        if size is None:
+            return 0
+        source_path = self.find(int(size), bitstream['checksum'])
+        if source_path is None:
+            return 0
+        destination_path = os.path.join(local_dir_path, midas_item_info['name'])
+        print "Reusing local file %s for %s" % (source_path, destination_path)
+        _reuse_local_file(source_path, destination_path, self.reuse)
+        self.add(destination_path, bitstream['checksum'])
+        self.progress.file_reused(int(size))
+        return int(size)
+
+
+class TransferScheduler(object):
+    """
+    Class for a size-aware transfer scheduler. Transfers of at least
+    large_file_size bytes (or of unknown size, such as entire Midas folders
+    to download) run on the large lanes, the others drain through the small lanes. Each
+    lane starts with its largest transfers, so that a huge file does not
+    start last and dominate the wall time.
+    """
+    def __init__(self, large_file_size, large_lanes, small_lanes):
+        self.large_file_size = large_file_size
+        self.lane_workers = {'large': large_lanes, 'small': small_lanes}
+        self.tasks = {'large': [ ], 'small': [ ]}
+        self.lock = threading.Lock()
+        self.failures = [ ]
+
+    def add(self, size, description, function, *args):
+        lane = 'small'
+        if size is None or size >= self.large_file_size:
+            lane = 'large'
+        self.tasks[lane].append((size, description, function, args))
+
+    def _run_lane(self, task_queue, stats, progress):
+        while True:
+            try:
+                size, description, function, args = task_queue.get_nowait()
+            except Queue.Empty:
+                return
+            started = time.time()
+            progress.transfer_started(size)
+            try:
+                # a download may return the number of bytes actually transferred,
+                # which excludes its unknown size or the local copies it reused
+                transferred = function(*args)
+            except Exception, detail:
+                print "Caught an error when transferring %s: %s" % (description, detail)
+                with self.lock:
+                    stats['failed'] += 1
+                    self.failures.append(description)
+                continue
+            finally:
+                progress.transfer_finished(size)
+            with self.lock:
+                stats['files'] += 1
+                stats['bytes'] += transferred if transferred is not None else size or 0
+                stats['busy_seconds'] += time.time() - started
+                stats['finished'] = time.time()
+
+    def run(self, progress):
+        """
+        Run all the transfers and return their per-lane statistics. Raise
+        TransferError once the lanes are drained if any transfer failed.
+        """
+        lane_stats = { }
+        workers = [ ]
+        started = time.time()
+        for lane, tasks in self.tasks.iteritems():
+            if not tasks:
+                continue
+            stats = lane_stats[lane] = {'workers': self.lane_workers[lane],
+                                        'files': 0, 'bytes': 0, 'failed': 0,
+                                        'busy_seconds': 0, 'finished': started}
+            task_queue = Queue.Queue()
+            # largest first, unknown sizes (entire Midas folders) before all
+            for task in sorted(tasks, key=lambda task: task[0] is None and float('inf') or task[0],
+                               reverse=True):
+                task_queue.put(task)
+            for i in xrange(min(self.lane_workers[lane], len(tasks))):
+                worker = threading.Thread(target=self._run_lane, args=(task_queue, stats, progress))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+        _wait_for_threads(workers)
+        for lane, stats in lane_stats.iteritems():
+            stats['wall_seconds'] = round(stats.pop('finished') - started, 1)
+            stats['busy_seconds'] = round(stats['busy_seconds'], 1)
+            stats['throughput_bytes_per_second'] = round(
+                stats['bytes'] / max(stats['wall_seconds'], 0.1), 1)
+        self.tasks = {'large': [ ], 'small': [ ]}
+        if lane_stats:
+            progress.add_lane_stats(lane_stats)
+            pp = pprint.PrettyPrinter(indent = 2)
+            print ("The transfer lanes statistics are as below: ")
+            pp.pprint(lane_stats)
+        if self.failures:
+            raise TransferError("%d transfers failed, run the same command again " \
+                "to resume: %s" % (len(self.failures), ', '.join(self.failures)))
+        return lane_stats
+
+
+class SyncProgress(object):
+    """
+    Class for live throughput and ETA reporting of a synchronization.
+    Every report_interval seconds a human readable line and a
+    machine-readable 'MSYNC_STATS <json>' line are printed.
+    """
+    def __init__(self, report_interval=10, rolling_window=60):
+        self.lock = threading.Lock()
+        self.report_interval = report_interval
+        self.rolling_window = rolling_window
+        self.started = time.time()
+        self.phase = None
+        self.phase_started = None
+        self.phase_seconds = { }
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        # done bytes which were not reused from local copies
+        self.transferred_bytes = 0
+        self.hashed_files = 0
+        self.hashed_bytes = 0
+        self.hash_seconds = 0
+        self.reused_files = 0
+        self.reused_bytes = 0
+        # pydas reads and writes whole files, the bytes of a file are only
+        # counted as done once it is transferred
+        self.in_flight_files = 0
+        self.in_flight_bytes = 0
+        self.lane_stats = { }
+        self.paused = False
+        self.paused_phase = None
+        # (timestamp, transferred_bytes) samples for the rolling throughput
+        self.samples = collections.deque()
+        self.stop_event = threading.Event()
+        self.reporter = None
+
+    def _end_phase_locked(self, now):
+        if self.phase is not None:
+            self.phase_seconds[self.phase] = self.phase_seconds.get(self.phase, 0) \
+                + now - self.phase_started
+        self.phase = None
+
+    def start_phase(self, phase):
+        with self.lock:
+            now = time.time()
+            self._end_phase_locked(now)
+            self.phase = phase
+            self.phase_started = now
+
+    def end_phase(self):
+        with self.lock:
+            self._end_phase_locked(time.time())
+
+    def pause(self):
+        # waiting for the user is neither reported nor timed as a phase
+        with self.lock:
+            self.paused = True
+            self.paused_phase = self.phase
+            self._end_phase_locked(time.time())
+
+    def resume(self):
+        with self.lock:
+            now = time.time()
+            self.paused = False
+            self.phase = self.paused_phase
+            self.phase_started = now
+            # restart the rolling throughput without the time spent waiting
+            self.samples.clear()
+            self.samples.append((now, self.transferred_bytes))
+
+    def file_hashed(self, size, seconds):
+        # hashing also runs in concurrent transfer lanes, so its time is summed
+        # on its own and is not taken out of the phase it happens in
+        with self.lock:
+            self.hashed_files += 1
+            self.hashed_bytes += size
+            self.hash_seconds += seconds
+
+    def add_to_plan(self, files, size):
+        with self.lock:
+            self.total_files += files
+            self.total_bytes += size
+            if not self.samples:
+                self.samples.append((time.time(), self.transferred_bytes))
+
+    def add_lane_stats(self, lane_stats):
+        # a download runs the scheduler twice, the lanes statistics add up
+        with self.lock:
+            for lane, stats in lane_stats.iteritems():
+                total = self.lane_stats.setdefault(lane, dict.fromkeys(stats, 0))
+                for key in ('files', 'bytes', 'failed', 'busy_seconds', 'wall_seconds'):
+                    total[key] += stats[key]
+                total['workers'] = stats['workers']
+                total['throughput_bytes_per_second'] = round(
+                    total['bytes'] / max(total['wall_seconds'], 0.1), 1)
+
+    def file_reused(self, size):
+        # a download satisfied with a local copy, counted by file_done as
+        # done but not as transferred
+        with self.lock:
+            self.reused_files += 1
+            self.reused_bytes += size
+
+    def transfer_started(self, size):
+        with self.lock:
+            self.in_flight_files += 1
+            self.in_flight_bytes += size or 0
+
+    def transfer_finished(self, size):
+        with self.lock:
+            self.in_flight_files -= 1
+            self.in_flight_bytes -= size or 0
+
+    def file_done(self, size, files=1, reused=0):
+        with self.lock:
+            self.done_files += files
+            self.done_bytes += size
+            self.transferred_bytes += max(size - reused, 0)
+            self.samples.append((time.time(), self.transferred_bytes))
+
+    def get_stats(self):
+        with self.lock:
+            now = time.time()
+            while len(self.samples) > 1 and now - self.samples[1][0] > self.rolling_window:
+                self.samples.popleft()
+            throughput = 0.0
+            if self.samples and now > self.samples[0][0]:
+                throughput = (self.transferred_bytes - self.samples[0][1]) \
+                    / (now - self.samples[0][0])
+            eta = None
+            if throughput > 0:
+                eta = max(self.total_bytes - self.done_bytes, 0) / throughput
+            phase_seconds = dict(self.phase_seconds)
+            if self.phase is not None:
+                phase_seconds[self.phase] = phase_seconds.get(self.phase, 0) \
+                    + now - self.phase_started
+            return {'phase': self.phase,
+                    'elapsed_seconds': round(now - self.started, 1),
+                    'phase_seconds': dict((k, round(v, 1)) for k, v in phase_seconds.iteritems()),
+                    'files_done': self.done_files,
+                    'files_total': self.total_files,
+                    'bytes_done': self.done_bytes,
+                    'bytes_total': self.total_bytes,
+                    'bytes_transferred': self.transferred_bytes,
+                    'files_in_flight': self.in_flight_files,
+                    'bytes_in_flight': self.in_flight_bytes,
+                    'hashed_files': self.hashed_files,
+                    'hashed_bytes': self.hashed_bytes,
+                    'hash_seconds': round(self.hash_seconds, 1),
+                    'reused_files': self.reused_files,
+                    'reused_bytes': self.reused_bytes,
+                    'lanes': dict((k, dict(v)) for k, v in self.lane_stats.iteritems()),
+                    'throughput_bytes_per_second': round(throughput, 1),
+                    'eta_seconds': None if eta is None else round(eta, 1)}
+
+    def report(self):
+        stats = self.get_stats()
+        eta = 'unknown'
+        if stats['eta_seconds'] is not None:
+            eta = str(datetime.timedelta(seconds=int(stats['eta_seconds'])))
+        in_flight = ''
+        if stats['files_in_flight']:
+            in_flight = ", %d in flight (%s)" % (stats['files_in_flight'],
+                                                 _format_bytes(stats['bytes_in_flight']))
+        reused = ''
+        if stats['reused_files']:
+            reused = ", %d local copies reused (%s not downloaded)" \
+                % (stats['reused_files'], _format_bytes(stats['reused_bytes']))
+        print ("[%s] %d/%d files, %s/%s%s, %s/s, ETA %s%s" % (
+            stats['phase'] or 'done', stats['files_done'], stats['files_total'],
+            _format_bytes(stats['bytes_done']), _format_bytes(stats['bytes_total']),
+            in_flight, _format_bytes(stats['throughput_bytes_per_second']), eta, reused))
+        print "MSYNC_STATS %s" % json.dumps(stats, sort_keys=True)
+        sys.stdout.flush()
+
+    def _report_periodically(self):
+        while True:
+            self.stop_event.wait(self.report_interval)
+            if self.stop_event.is_set():
+                return
+            if not self.paused:
+                self.report()
+
+    def start_reporting(self):
+        if self.report_interval <= 0:
+            return
+        self.reporter = threading.Thread(target=self._report_periodically)
+        self.reporter.daemon = True
+        self.reporter.start()
+
+    def stop_reporting(self):
+        self.end_phase()
+        self.stop_event.set()
+        if self.reporter is not None:
+            self.reporter.join()
+        self.report()
 
         
 class Usage(Exception):
     def __init__(self, msg):
         self.msg = msg
+
+
+class TransferError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
         
 
+def _wait_for_threads(threads):
+    """
+    Helper function to wait until all the threads are finished
+    """
+    for thread in threads:
+        # join with a timeout so that Ctrl-C still interrupts the main thread
+        while thread.is_alive():
+            thread.join(1)
+
+
+def _format_bytes(size):
+    """
+    Helper function to format a number of bytes in a human readable way
+    """
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(size) < 1024.0 or unit == 'TB':
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+
+
+def _get_local_dir_size(local_dir):
+    """
+    Helper function to get the number of files and bytes in a local directory
+    """
+    files = 0
+    size = 0
+    for root, dirs, filenames in os.walk(local_dir):
+        for filename in filenames:
+            files += 1
+            size += os.path.getsize(os.path.join(root, filename))
+    return files, size
+
+
+def _in_shard(sync_setting, parent_dir, name):
+    """
+    Helper function to check if a local file or directory (or the Midas
+    resource mirroring it) belongs to the shard of this process. The stable
+    hash of its top level directory (or of its whole relative path) decides.
+    """
+    if sync_setting.shard is None:
+        return True
+    shard_index, shard_count = sync_setting.shard
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    relative_path = os.path.relpath(os.path.join(parent_dir, name),
+                                    sync_setting.local_root_dir)
+    if sync_setting.shard_by == 'topdir':
+        relative_path = relative_path.split(os.sep)[0]
+    return int(hashlib.md5(relative_path).hexdigest(), 16) % shard_count == shard_index
+
+
 def _md5_for_file(file, block_size=8192):
     """
     Helper function to calculate the md5 checksum for a local file
@@ -212,6 +744,17 @@ def _query_yes_no(question, default="no"):
                              "(or 'y' or 'n').\n")    
 
 
+def _query_yes_no_paused(progress, question):
+    """
+    Helper function to ask a yes/no question with the progress reports paused
+    """
+    progress.pause()
+    try:
+        return _query_yes_no(question)
+    finally:
+        progress.resume()
+
+
 def sanity_check(sync_setting):
     """
     Sanity check for input parameters
@@ -245,7 +788,294 @@ def sanity_check(sync_setting):
     return True
 
 
-def check_sync_status(sync_setting):
+def _list_local_dir(local_dir):
+    """
+    Helper function to get the relative paths of the files in a local directory
+    """
+    relative_paths = [ ]
+    for root, dirs, files in os.walk(local_dir, topdown=True):
+        # ignore hidden directories
+        dirs[:] = [d for d in dirs if not d[0] == '.']
+        for filename in files:
+            relative_paths.append(os.path.relpath(os.path.join(root, filename), local_dir))
+    return relative_paths
+
+
+def _get_local_dir_manifest(local_dir, progress):
+    """
+    Helper function to get the md5 checksum of each file in a local directory,
+    indexed by relative path
+    """
+    manifest = { }
+    for relative_path in _list_local_dir(local_dir):
+        local_file_path = os.path.join(local_dir, relative_path)
+        hash_started = time.time()
+        manifest[relative_path] = _md5_for_file(local_file_path)
+        progress.file_hashed(os.path.getsize(local_file_path),
+                             time.time() - hash_started)
+    return manifest
+
+
+def _get_midas_folder_manifest(midas_folder_id, relative_dir=''):
+    """
+    Helper function to get the checksum of each item in a Midas folder,
+    indexed by relative path
+    """
+    manifest = { }
+    for resource_type, resource_list in pydas.session.communicator.folder_children(
+      pydas.session.token, midas_folder_id).iteritems():
+        if resource_type == 'folders':
+            for midas_folder in resource_list:
+                manifest.update(_get_midas_folder_manifest(midas_folder['folder_id'],
+                    os.path.join(relative_dir, midas_folder['name'])))
+        elif resource_type == 'items':
+            for midas_item in resource_list:
+                midas_item_info = pydas.session.communicator.item_get(
+                    pydas.session.token, midas_item['item_id'])
+                checksum = None
+                if midas_item_info['revisions'] \
+                   and midas_item_info['revisions'][-1]['bitstreams']:
+                    checksum = midas_item_info['revisions'][-1]['bitstreams'][0]['checksum']
+                manifest[os.path.join(relative_dir, midas_item['name'])] = checksum
+    return manifest
+
+
+def _collect_move_candidates(midas_folder_id, ancestors, dir_names, file_names,
+                             midas_folders, midas_items):
+    """
+    Helper function to recursively collect the folders and items of a Midas
+    only folder whose name matches a local only directory or file
+    """
+    ancestors = ancestors + [midas_folder_id]
+    for resource_type, resource_list in pydas.session.communicator.folder_children(
+      pydas.session.token, midas_folder_id).iteritems():
+        if resource_type == 'folders':
+            for midas_folder in resource_list:
+                if midas_folder['name'] in dir_names:
+                    midas_folders.setdefault(midas_folder['name'], []).append(
+                        {'folder_id': midas_folder['folder_id'], 'ancestors': ancestors})
+                _collect_move_candidates(midas_folder['folder_id'], ancestors, dir_names,
+                                         file_names, midas_folders, midas_items)
+        elif resource_type == 'items':
+            for midas_item in resource_list:
+                if midas_item['name'] in file_names:
+                    midas_items.setdefault(midas_item['name'], []).append(
+                        {'item_id': midas_item['item_id'], 'ancestors': ancestors})
+
+
+def _detect_moves(sync_setting, sync_status, progress):
+    """
+    Match local only directories and files against Midas only folders and
+    items (or their descendants) with the same name and content. Such pairs
+    are relocations, and are synchronized with a move instead of a transfer
+    and a deletion.
+    """
+    dir_names = set(os.path.basename(dir) for dir in sync_status.only_local['entire_dirs'])
+    file_names = set(os.path.basename(file_info['filepath'])
+                     for file_info in sync_status.only_local['files'])
+    # the files under a local only directory can be moved one by one if the
+    # directory as a whole is not, in download mode they are deleted instead
+    dir_files = { }
+    if sync_setting.mode != 'download':
+        for dir in sync_status.only_local['entire_dirs']:
+            dir_files[dir] = [os.path.join(dir, relative_path)
+                              for relative_path in _list_local_dir(dir)]
+            file_names.update(os.path.basename(filepath) for filepath in dir_files[dir])
+    # candidates: name -> [{'folder_id' or 'item_id', 'ancestors'}]
+    midas_folders = { }
+    midas_items = { }
+    for midas_folder in sync_status.only_midas['entire_folders']:
+        folder_id = os.path.basename(midas_folder)
+        folder_info = pydas.session.communicator.folder_get(pydas.session.token, folder_id)
+        if folder_info['name'] in dir_names:
+            midas_folders.setdefault(folder_info['name'], []).append(
+                {'folder_id': folder_id, 'ancestors': []})
+        # in download mode, the content of a Midas only folder is downloaded
+        # with it, so only the folder itself can be matched
+        if sync_setting.mode != 'download':
+            _collect_move_candidates(folder_id, [], dir_names, file_names,
+                                     midas_folders, midas_items)
+    for midas_item in sync_status.only_midas['items']:
+        midas_items.setdefault(None, []).append(
+            {'item_id': os.path.basename(midas_item), 'ancestors': []})
+    # a folder cannot be moved if one of its ancestors or descendants is moved
+    moved_folder_ids = set()
+    touched_folder_ids = set()
+
+    for dir in list(sync_status.only_local['entire_dirs']):
+        for candidate in midas_folders.get(os.path.basename(dir), []):
+            if candidate['folder_id'] in touched_folder_ids \
+                or moved_folder_ids.intersection(candidate['ancestors']):
+                continue
+            midas_manifest = _get_midas_folder_manifest(candidate['folder_id'])
+            # compare the file names before hashing the local directory
+            if set(midas_manifest.keys()) != set(_list_local_dir(dir)) \
+                or midas_manifest != _get_local_dir_manifest(dir, progress):
+                continue
+            midas_folder = os.path.join(sync_setting.midas_url, 'folder', candidate['folder_id'])
+            sync_status.moves['folders'].append(
+                {'dirpath': dir, 'midas_folder': midas_folder,
+                 'midas_folder_id': candidate['folder_id'],
+                 'dest_folder_id': sync_status.midas_parent_folder_ids.get(dir)})
+            sync_status.only_local['entire_dirs'].remove(dir)
+            if midas_folder in sync_status.only_midas['entire_folders']:
+                sync_status.only_midas['entire_folders'].remove(midas_folder)
+            moved_folder_ids.add(candidate['folder_id'])
+            touched_folder_ids.update(candidate['ancestors'])
+            midas_folders[os.path.basename(dir)].remove(candidate)
+            break
+
+    # index the item candidates by (name, checksum)
+    indexed_items = { }
+    for candidate in sum(midas_items.values(), []):
+        if moved_folder_ids.intersection(candidate['ancestors']):
+            continue
+        midas_item_info = pydas.session.communicator.item_get(
+            pydas.session.token, candidate['item_id'])
+        if midas_item_info['name'] not in file_names \
+            or not midas_item_info['revisions'] \
+            or not midas_item_info['revisions'][-1]['bitstreams']:
+            continue
+        checksum = midas_item_info['revisions'][-1]['bitstreams'][0]['checksum']
+        candidate['folder_id'] = midas_item_info['folder_id']
+        indexed_items.setdefault((midas_item_info['name'], checksum), []).append(candidate)
+    if not indexed_items:
+        return
+    item_names = set(name for name, checksum in indexed_items.iterkeys())
+    # (local file path, only_local file info or None, local only directory or None)
+    local_files = [(file_info['filepath'], file_info, None)
+                   for file_info in sync_status.only_local['files']]
+    for dir in sync_status.only_local['entire_dirs']:
+        local_files.extend((filepath, None, dir) for filepath in dir_files.get(dir, [ ]))
+    moved_file_paths = set()
+    for filepath, file_info, dir in local_files:
+        filename = os.path.basename(filepath)
+        if filename not in item_names:
+            continue
+        hash_started = time.time()
+        local_file_checksum = _md5_for_file(filepath)
+        progress.file_hashed(os.path.getsize(filepath), time.time() - hash_started)
+        candidates = indexed_items.get((filename, local_file_checksum))
+        if not candidates:
+            continue
+        candidate = candidates.pop()
+        midas_item = os.path.join(sync_setting.midas_url, 'item', candidate['item_id'])
+        # the destination folder of a file under a local only directory is
+        # only known once the folder is created in Midas
+        sync_status.moves['items'].append(
+            {'filepath': filepath, 'midas_item': midas_item,
+             'midas_item_id': candidate['item_id'],
+             'src_folder_id': candidate['folder_id'],
+             'dest_folder_id': file_info and file_info['midas_upload_folder_id']})
+        if file_info is not None:
+            sync_status.only_local['files'].remove(file_info)
+        moved_file_paths.add(filepath)
+        if midas_item in sync_status.only_midas['items']:
+            sync_status.only_midas['items'].remove(midas_item)
+    for dir in list(sync_status.only_local['entire_dirs']):
+        if moved_file_paths.intersection(dir_files.get(dir, [ ])):
+            _split_local_only_dir(sync_status, dir, moved_file_paths)
+
+
+def _split_local_only_dir(sync_status, dir, moved_file_paths):
+    """
+    Helper function to replace a local only directory by the Midas folders to
+    create for it and the files to upload into them, so that the files moved
+    into it are not uploaded again
+    """
+    sync_status.only_local['entire_dirs'].remove(dir)
+    for root, dirs, files in os.walk(dir, topdown=True):
+        # ignore hidden directories
+        dirs[:] = [d for d in dirs if not d[0] == '.']
+        sync_status.moves['new_folders'].append(
+            {'dirpath': root,
+             'parent_folder_id': sync_status.midas_parent_folder_ids.get(root)})
+        for filename in files:
+            local_file_path = os.path.join(root, filename)
+            if local_file_path not in moved_file_paths:
+                sync_status.only_local['files'].append(
+                    {'filepath': local_file_path, 'midas_upload_folder_id': None})
+
+
+def _resolve_new_folders(sync_status, created_folder_ids):
+    """
+    Helper function to fill in the Midas folder ids of the directories created
+    in Midas, given as a lookup table: local directory -> Midas folder id
+    """
+    for new_folder in sync_status.moves['new_folders']:
+        parent_dir = os.path.dirname(new_folder['dirpath'])
+        if new_folder['parent_folder_id'] is None and parent_dir in created_folder_ids:
+            new_folder['parent_folder_id'] = created_folder_ids[parent_dir]
+    for move in sync_status.moves['items']:
+        dir = os.path.dirname(move['filepath'])
+        if move['dest_folder_id'] is None and dir in created_folder_ids:
+            move['dest_folder_id'] = created_folder_ids[dir]
+    for file_info in sync_status.only_local['files']:
+        dir = os.path.dirname(file_info['filepath'])
+        if file_info['midas_upload_folder_id'] is None and dir in created_folder_ids:
+            file_info['midas_upload_folder_id'] = created_folder_ids[dir]
+
+
+def _write_sync_report(sync_setting, sync_status):
+    """
+    Helper function to save the synchronization status of this process (shard)
+    so that it can be merged with the other shards' reports
+    """
+    report = {'shard': sync_setting.shard,
+              'shard_by': sync_setting.shard_by,
+              'local_root_dir': sync_setting.local_root_dir,
+              'midas_url': sync_setting.midas_url,
+              'midas_root_folder_id': sync_setting.midas_root_folder_id,
+              'sync_status': sync_status.to_dict()}
+    with open(sync_setting.report_file, 'w') as f:
+        json.dump(report, f)
+
+
+def merge_sync_reports(report_files):
+    """
+    Merge the synchronization status reports of several shards into one.
+    The merged status is None if the reports are about different targets.
+    """
+    merged_status = SyncStatusDict()
+    targets = set()
+    shard_counts = set()
+    shard_indexes = set()
+    for report_file in report_files:
+        with open(report_file, 'r') as f:
+            report = json.load(f)
+        targets.add((report['local_root_dir'], report['midas_url'],
+                     report['midas_root_folder_id'], report['shard_by']))
+        shard_index, shard_count = report['shard'] or (0, 1)
+        shard_counts.add(shard_count)
+        shard_indexes.add(shard_index)
+        sync_status = SyncStatusDict.from_dict(report['sync_status'])
+        merged_status.only_local['entire_dirs'].extend(sync_status.only_local['entire_dirs'])
+        merged_status.only_local['files'].extend(sync_status.only_local['files'])
+        merged_status.only_midas['entire_folders'].extend(
+            sync_status.only_midas['entire_folders'])
+        merged_status.only_midas['items'].extend(sync_status.only_midas['items'])
+        merged_status.needs_update['files'].extend(sync_status.needs_update['files'])
+        merged_status.moves['folders'].extend(sync_status.moves['folders'])
+        merged_status.moves['items'].extend(sync_status.moves['items'])
+        merged_status.moves['new_folders'].extend(sync_status.moves['new_folders'])
+        merged_status.midas_item_sizes.update(sync_status.midas_item_sizes)
+        merged_status.midas_parent_folder_ids.update(sync_status.midas_parent_folder_ids)
+    if len(targets) > 1:
+        print ("Caught a sanity check error: the reports are about different " \
+               "local directories, Midas folders or shard modes!")
+        return False, None
+    if len(shard_counts) > 1 or shard_indexes != set(range(shard_counts.pop())):
+        print ("Warning: the reports do not cover all the shards, " \
+               "the merged synchronization status is incomplete!")
+    if merged_status.is_empty():
+        print "All data are synchronized between the local directory and the Midas folder!"
+        return True, merged_status
+    else:
+        merged_status.pprint()
+        return False, merged_status
+
+
+def check_sync_status(sync_setting, progress):
     """
     Check data synchronize status between a local directory and a Mids folder
     """
@@ -265,6 +1095,10 @@ def check_sync_status(sync_setting):
     for root, dirs, files in os.walk(sync_setting.local_root_dir, topdown=True):
         # ignore hidden directories
         dirs[:] = [d for d in dirs if not d[0] == '.']
+        # in topdir shard mode, the other shards' top level directories are not walked
+        if sync_setting.shard is not None and sync_setting.shard_by == 'topdir' \
+            and root == sync_setting.local_root_dir:
+            dirs[:] = [d for d in dirs if _in_shard(sync_setting, root, d)]
         midas_children_folders.clear()
         midas_children_items.clear()
 
@@ -286,18 +1120,22 @@ def check_sync_status(sync_setting):
                 sync_status.only_local['entire_dirs'].append(root)
 
         # for a given local directory (root), check its sub directories (dirs)
-        for dir_name in dirs:
+        for dir_name in list(dirs):
             local_dir_path = os.path.join(root, dir_name)
             if dir_name in midas_children_folders.keys():
                 midas_folder_ids_lookup[local_dir_path] = midas_children_folders[dir_name]['folder_id']
                 midas_children_folders[dir_name]['in_local'] = True
+            elif not _in_shard(sync_setting, root, dir_name):
+                dirs.remove(dir_name)
             else:
                 sync_status.only_local['entire_dirs'].append(local_dir_path)
+                sync_status.midas_parent_folder_ids[local_dir_path] = midas_folder_ids_lookup[root]
 
         # for a given local directory (root), check its files (files)
         for filename in files:
             local_file_path = os.path.join(root, filename)
-            if root in sync_status.only_local['entire_dirs']:
+            if root in sync_status.only_local['entire_dirs'] \
+                or not _in_shard(sync_setting, root, filename):
                 continue
             elif filename not in midas_children_items.keys():
                 sync_status.only_local['files'].append(
@@ -307,7 +1145,10 @@ def check_sync_status(sync_setting):
                 midas_children_items[filename]['in_local'] = True
                 midas_item_info = pydas.session.communicator.item_get(
                     pydas.session.token, midas_children_items[filename]['item_id'])
+                hash_started = time.time()
                 local_file_checksum = _md5_for_file(local_file_path)
+                progress.file_hashed(os.path.getsize(local_file_path),
+                                     time.time() - hash_started)
                 # assumptions for the items in Midas: 
                 # 1) use the latest revision for each item 
                 # 2) each item only contains one bitstream
@@ -319,17 +1160,28 @@ def check_sync_status(sync_setting):
                 sync_status.needs_update['files'].append(
                         {'filepath': local_file_path, 
                          'midas_item_id': midas_item_info['item_id']})
+                sync_status.midas_item_sizes[midas_item_info['item_id']] = \
+                    int(midas_children_items[filename].get('sizebytes', 0))
       
         # check midas_only entire_folders and items
         for folder_name, folder_info in midas_children_folders.iteritems():
-            if 'in_local' not in folder_info.keys() or not folder_info['in_local']:
+            if ('in_local' not in folder_info.keys() or not folder_info['in_local']) \
+                and _in_shard(sync_setting, root, folder_name):
                 sync_status.only_midas['entire_folders'].append(
                     os.path.join(sync_setting.midas_url, 'folder', folder_info['folder_id']))
         for item_name, item_info in midas_children_items.iteritems():
-             if 'in_local' not in item_info.keys() or not item_info['in_local']:
+             if ('in_local' not in item_info.keys() or not item_info['in_local']) \
+                 and _in_shard(sync_setting, root, item_name):
                  sync_status.only_midas['items'].append(
                     os.path.join(sync_setting.midas_url, 'item', item_info['item_id']))
+                 sync_status.midas_item_sizes[item_info['item_id']] = \
+                    int(item_info.get('sizebytes', 0))
 
+    if (sync_status.only_local['entire_dirs'] or sync_status.only_local['files']) \
+        and (sync_status.only_midas['entire_folders'] or sync_status.only_midas['items']):
+        _detect_moves(sync_setting, sync_status, progress)
+    if sync_setting.report_file is not None:
+        _write_sync_report(sync_setting, sync_status)
     # display synchronization status
     if sync_status.is_empty():
         print "All data are synchronized between the local directory and the Midas folder!"
@@ -339,59 +1191,199 @@ def check_sync_status(sync_setting):
         return False, sync_status
 
 
-def mirror_data_to_midas(sync_setting, sync_status):
+def _upload_entire_dir(dir, pydas_upload_destination, dir_size, sync_status,
+                       progress, journal):
+    """
+    Helper function to upload an entire local directory to Midas
+    """
+    journal.record('dir_upload_started', target=dir,
+                   parent_folder_id=sync_status.midas_parent_folder_ids.get(dir))
+    pydas.upload(dir, destination=pydas_upload_destination)
+    journal.record('dir_uploaded', target=dir)
+    files, size = dir_size
+    progress.file_done(size, files=files)
+
+
+def _upload_new_file(file_info, progress, journal):
+    """
+    Helper function to upload a local file to a new Midas item
+    """
+    filepath = file_info['filepath']
+    filename = os.path.basename(filepath)
+    upload_folder_id = file_info['midas_upload_folder_id']
+    print "Uploading Item from %s" % filepath
+    item = pydas.session.communicator.create_item(
+        pydas.session.token, filename, upload_folder_id)
+    journal.record('item_created', target=filepath, item_id=item['item_id'])
+    upload_token = pydas.session.communicator.generate_upload_token(
+        pydas.session.token, item['item_id'], filename)
+    pydas.session.communicator.perform_upload(
+        upload_token, filepath, itemid=item['item_id'])
+    journal.record('file_uploaded', target=filepath)
+    progress.file_done(os.path.getsize(filepath))
+
+
+def _upload_updated_file(file_info, progress, journal):
+    """
+    Helper function to upload a local file as a new revision of its Midas item
+    """
+    filepath = file_info['filepath']
+    filename = os.path.basename(filepath)
+    upload_item_id = file_info['midas_item_id']
+    print "Updating Item from %s" % filepath
+    upload_token = pydas.session.communicator.generate_upload_token(
+        pydas.session.token, upload_item_id, filename)
+    pydas.session.communicator.perform_upload(
+        upload_token, filename, itemid=upload_item_id, revision=None, filepath=filepath)
+    journal.record('file_updated', target=filepath)
+    progress.file_done(os.path.getsize(filepath))
+
+
+def mirror_data_to_midas(sync_setting, sync_status, progress, journal):
     """
     Mirror local data to Midas
     """
     print "\nStart mirroring(uploading) local data to Midas."
+    progress.start_phase('transfer')
+    entire_dir_sizes = { }
+    for dir in sync_status.only_local['entire_dirs']:
+        entire_dir_sizes[dir] = _get_local_dir_size(dir)
+        progress.add_to_plan(*entire_dir_sizes[dir])
+    for file_info in sync_status.only_local['files'] + sync_status.needs_update['files']:
+        progress.add_to_plan(1, os.path.getsize(file_info['filepath']))
+    # create the folders receiving moved items, they are created top-down
+    created_folder_ids = { }
+    for new_folder in sync_status.moves['new_folders']:
+        _resolve_new_folders(sync_status, created_folder_ids)
+        print "Creating Folder for %s" % new_folder['dirpath']
+        # reuse the folder if it was created by an interrupted run
+        midas_folder = pydas.session.communicator.create_folder(
+            pydas.session.token, os.path.basename(new_folder['dirpath']),
+            new_folder['parent_folder_id'], reuse_existing=True)
+        created_folder_ids[new_folder['dirpath']] = midas_folder['folder_id']
+        journal.record('folder_created', target=new_folder['dirpath'],
+                       folder_id=midas_folder['folder_id'])
+    _resolve_new_folders(sync_status, created_folder_ids)
+    # move the relocated folders and items in Midas instead of uploading them
+    for move in sync_status.moves['folders']:
+        print "Moving Folder %s to mirror %s" % (move['midas_folder'], move['dirpath'])
+        pydas.session.communicator.move_folder(
+            pydas.session.token, move['midas_folder_id'], move['dest_folder_id'])
+        journal.record('folder_moved', target=move['dirpath'])
+    for move in sync_status.moves['items']:
+        print "Moving Item %s to mirror %s" % (move['midas_item'], move['filepath'])
+        pydas.session.communicator.move_item(pydas.session.token, move['midas_item_id'],
+            move['src_folder_id'], move['dest_folder_id'])
+        journal.record('item_moved', target=move['filepath'])
+    scheduler = TransferScheduler(sync_setting.large_file_size,
+                                  sync_setting.large_lanes, sync_setting.small_lanes)
     # upload 'local_only' data to Midas
     pydas_root_upload_destination = _get_pydas_resource_path(
         sync_setting.midas_root_folder_id)
+    # an entire local directory is scheduled by its total size
     for dir in sync_status.only_local['entire_dirs']:
         pydas_upload_destination = os.path.dirname(
             pydas_root_upload_destination + dir.split(sync_setting.local_root_dir)[-1])
-        pydas.upload(dir, destination=pydas_upload_destination)
+        scheduler.add(entire_dir_sizes[dir][1], dir, _upload_entire_dir, dir,
+                      pydas_upload_destination, entire_dir_sizes[dir], sync_status,
+                      progress, journal)
     for file_info in sync_status.only_local['files']:
-        filepath = file_info['filepath']
-        filename = os.path.basename(filepath)
-        upload_folder_id = file_info['midas_upload_folder_id']
-        print "Uploading Item from %s" % filepath
-        item = pydas.session.communicator.create_item(
-            pydas.session.token, filename, upload_folder_id)
-        upload_token = pydas.session.communicator.generate_upload_token(
-            pydas.session.token, item['item_id'], filename)
-        pydas.session.communicator.perform_upload(
-            upload_token, filepath, itemid=item['item_id'])
+        scheduler.add(os.path.getsize(file_info['filepath']), file_info['filepath'],
+                      _upload_new_file, file_info, progress, journal)
     # upload 'needs_update' data to Midas
     for file_info in sync_status.needs_update['files']:
-        filepath = file_info['filepath']
-        filename = os.path.basename(filepath)
-        upload_item_id = file_info['midas_item_id']
-        print "Updating Item from %s" % filepath
-        upload_token = pydas.session.communicator.generate_upload_token(
-            pydas.session.token, upload_item_id, filename)
-        pydas.session.communicator.perform_upload(
-            upload_token, filename, itemid=upload_item_id, revision=None, filepath=filepath)
+        scheduler.add(os.path.getsize(file_info['filepath']), file_info['filepath'],
+                      _upload_updated_file, file_info, progress, journal)
+    scheduler.run(progress)
+    progress.end_phase()
     # process 'midas_only' data
     if sync_status.only_midas['entire_folders'] or sync_status.only_midas['items']:
-        agree_to_delete = _query_yes_no("Some folders and/or items only exist in Midas. "  \
+        agree_to_delete = _query_yes_no_paused(progress,
+            "Some folders and/or items only exist in Midas. "  \
             "Do you want to delete them (delete operation cannot be undo)?")
         if agree_to_delete:
             for folder in sync_status.only_midas['entire_folders']:
                 pydas.session.communicator.delete_folder(
                     pydas.session.token, os.path.basename(folder))
+                journal.record('folder_deleted', target=folder)
             for item in sync_status.only_midas['items']:
                 pydas.session.communicator.delete_item(
-                    pydas.session.token, os.path.basename(item))      
+                    pydas.session.token, os.path.basename(item))
+                journal.record('item_deleted', target=item)
     print ("Data in %s has been mirrored(uploaded) to %s.\n" \
             % (sync_setting.local_root_dir, os.path.join(sync_setting.midas_url, 
                'folder', sync_setting.midas_root_folder_id)))
 
 
-def _download_entire_midas_folder(midas_folder_id, local_dir_path) :
+def _move_local_path(source_path, destination_path):
+    """
+    Helper function to move a local file or directory, creating the missing
+    parent directories of the destination
+    """
+    destination_dir = os.path.dirname(destination_path)
+    if not os.path.isdir(destination_dir):
+        os.makedirs(destination_dir)
+    os.rename(source_path, destination_path)
+
+
+def _reuse_local_file(source_path, destination_path, reuse):
+    """
+    Helper function to create destination_path with the content of a local
+    file, by a hardlink, a reflink (copy-on-write clone) or a plain copy.
+    Hardlinks and reflinks fall back to a copy if the filesystem refuses.
+    """
+    if reuse == 'hardlink':
+        try:
+            os.link(source_path, destination_path)
+            return
+        except OSError:
+            pass
+    elif reuse == 'reflink':
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(['cp', '--reflink=always', source_path, destination_path],
+                               stdout=devnull, stderr=devnull) == 0:
+                return
+    shutil.copy2(source_path, destination_path)
+
+
+def _download_midas_item(midas_item_id, local_dir_path, content_index=None):
     """
-    Helper function to download an entire midas folder to a local directory
+    Helper function to download a Midas item to a local directory, or to copy
+    a local file with the same content if content_index is given. Return the
+    number of bytes reused.
     """
+    if content_index is not None:
+        midas_item_info = pydas.session.communicator.item_get(
+            pydas.session.token, midas_item_id)
+        reused_bytes = content_index.reuse_for_item(midas_item_info, local_dir_path)
+        if reused_bytes:
+            return reused_bytes
+    pydas_download_source = _get_pydas_resource_path(midas_item_id, type='item')
+    pydas.download(pydas_download_source, local_path=local_dir_path)
+    return 0
+
+
+def _download_entire_midas_folder(midas_folder_id, local_dir_path, content_index=None) :
+    """
+    Helper function to download an entire midas folder to a local directory.
+    Return the number of bytes reused.
+    """
+    if content_index is not None:
+        reused_bytes = 0
+        # walk the folder ourselves so that each item can reuse a local copy
+        for resource_type, resource_list in pydas.session.communicator.folder_children(
+          pydas.session.token, midas_folder_id).iteritems():
+            if resource_type == 'folders':
+                for midas_folder in resource_list:
+                    local_sub_dir_path = os.path.join(local_dir_path, midas_folder['name'])
+                    os.mkdir(local_sub_dir_path)
+                    reused_bytes += _download_entire_midas_folder(
+                        midas_folder['folder_id'], local_sub_dir_path, content_index)
+            elif resource_type == 'items':
+                for midas_item in resource_list:
+                    reused_bytes += _download_midas_item(
+                        midas_item['item_id'], local_dir_path, content_index)
+        return reused_bytes
     for resource_type, resource_list in pydas.session.communicator.folder_children(
       pydas.session.token, midas_folder_id).iteritems():
         if resource_type == 'folders':
@@ -403,73 +1395,302 @@ def _download_entire_midas_folder(midas_folder_id, local_dir_path) :
                 pydas_download_source = _get_pydas_resource_path(
                     midas_item['item_id'], type='item')
                 pydas.download(pydas_download_source, local_path=local_dir_path)
+    return 0
+
+def _download_only_midas_folder(sync_setting, midas_folder, content_index,
+                                progress, journal):
+    """
+    Helper function to download a Midas only folder to its local destination
+    """
+    local_desitnation =_get_local_download_destination(
+        os.path.basename(midas_folder), sync_setting.local_root_dir,
+        type='folder', root_folder_id=sync_setting.midas_root_folder_id)
+    print 'Creating Folder at %s' % local_desitnation
+    journal.record('folder_download_started', target=midas_folder,
+                   local_path=local_desitnation)
+    os.mkdir(local_desitnation)
+    reused_bytes = _download_entire_midas_folder(os.path.basename(midas_folder),
+                           local_dir_path=local_desitnation, content_index=content_index)
+    journal.record('folder_downloaded', target=midas_folder)
+    files, size = _get_local_dir_size(local_desitnation)
+    progress.add_to_plan(files, size)
+    progress.file_done(size, files=files, reused=reused_bytes)
+    return size - reused_bytes
 
-def download_data_to_local(sync_setting, sync_status):
+
+def _download_only_midas_item(sync_setting, midas_item, size, content_index,
+                              progress, journal):
+    """
+    Helper function to download a Midas only item to its local destination
+    """
+    local_desitnation = _get_local_download_destination(
+        os.path.basename(midas_item), sync_setting.local_root_dir,
+        type='item', root_folder_id=sync_setting.midas_root_folder_id)
+    reused_bytes = _download_midas_item(os.path.basename(midas_item),
+                                        local_desitnation, content_index)
+    journal.record('item_downloaded', target=midas_item)
+    progress.file_done(size, reused=reused_bytes)
+    return max(size - reused_bytes, 0)
+
+
+def _overwrite_local_file(file, size, content_index, progress, journal):
+    """
+    Helper function to overwrite a local file with its Midas item
+    """
+    # the file is already removed if a previous run was interrupted
+    if os.path.exists(file['filepath']):
+        os.remove(file['filepath'])
+    reused_bytes = _download_midas_item(file['midas_item_id'],
+                                        os.path.dirname(file['filepath']), content_index)
+    journal.record('file_overwritten', target=file['filepath'])
+    progress.file_done(size, reused=reused_bytes)
+    return max(size - reused_bytes, 0)
+
+
+def _cancel_moves(sync_status):
+    """
+    Helper function to transfer the relocated resources again instead of
+    moving them, their old copies are then left to the deletion prompt
+    """
+    for move in sync_status.moves['folders']:
+        sync_status.only_local['entire_dirs'].append(move['dirpath'])
+        sync_status.only_midas['entire_folders'].append(move['midas_folder'])
+    for move in sync_status.moves['items']:
+        sync_status.only_local['files'].append(
+            {'filepath': move['filepath'], 'midas_upload_folder_id': move['dest_folder_id']})
+        sync_status.only_midas['items'].append(move['midas_item'])
+    sync_status.moves['folders'] = [ ]
+    sync_status.moves['items'] = [ ]
+
+
+def download_data_to_local(sync_setting, sync_status, progress, journal):
     """
     Mirror data from a Midas folder to a local directory
     """
     print "\nStart mirroring(downloading) data from Midas to local directory."
+    # moving local data is asked for like deleting it
+    if sync_status.moves['folders'] or sync_status.moves['items']:
+        agree_to_move = _query_yes_no_paused(progress,
+            "Some local directories and/or files were moved in Midas. "  \
+            "Do you want to move your local copies accordingly (otherwise they are " \
+            "downloaded again at their new location)?")
+        if not agree_to_move:
+            _cancel_moves(sync_status)
+            journal.record('moves_cancelled', target=None)
+    progress.start_phase('transfer')
+    # the size of an entire Midas folder is only known once it is downloaded
+    for midas_item in sync_status.only_midas['items']:
+        progress.add_to_plan(1, sync_status.midas_item_sizes.get(
+            os.path.basename(midas_item), 0))
+    for file in sync_status.needs_update['files']:
+        progress.add_to_plan(1, sync_status.midas_item_sizes.get(file['midas_item_id'], 0))
+    content_index = None
+    if sync_setting.reuse is not None:
+        print "Indexing local files to reuse them instead of downloading identical items."
+        content_index = LocalContentIndex(sync_setting.local_root_dir,
+                                          sync_setting.reuse, progress)
+    # move the relocated local directories and files instead of downloading them
+    for move in sync_status.moves['folders']:
+        local_desitnation = _get_local_download_destination(
+            move['midas_folder_id'], sync_setting.local_root_dir,
+            type='folder', root_folder_id=sync_setting.midas_root_folder_id)
+        print "Moving Directory %s to %s" % (move['dirpath'], local_desitnation)
+        _move_local_path(move['dirpath'], local_desitnation)
+        journal.record('dir_moved', target=move['dirpath'])
+    for move in sync_status.moves['items']:
+        local_desitnation = os.path.join(_get_local_download_destination(
+            move['midas_item_id'], sync_setting.local_root_dir,
+            type='item', root_folder_id=sync_setting.midas_root_folder_id),
+            os.path.basename(move['filepath']))
+        print "Moving File %s to %s" % (move['filepath'], local_desitnation)
+        _move_local_path(move['filepath'], local_desitnation)
+        journal.record('file_moved', target=move['filepath'])
+    scheduler = TransferScheduler(sync_setting.large_file_size,
+                                  sync_setting.large_lanes, sync_setting.small_lanes)
     # process 'only_midas' data
     for midas_folder in sync_status.only_midas['entire_folders']:
-        local_desitnation =_get_local_download_destination(                                                     
-            os.path.basename(midas_folder), sync_setting.local_root_dir, 
-            type='folder', root_folder_id=sync_setting.midas_root_folder_id)
-        print 'Creating Folder at %s' % local_desitnation
-        os.mkdir(local_desitnation)
-        _download_entire_midas_folder(os.path.basename(midas_folder),
-                               local_dir_path=local_desitnation)
+        # the size of an entire folder is unknown, it uses a large lane
+        scheduler.add(None, midas_folder, _download_only_midas_folder, sync_setting,
+                      midas_folder, content_index, progress, journal)
     for midas_item in sync_status.only_midas['items']:
-        pydas_download_source = _get_pydas_resource_path(
-            os.path.basename(midas_item), type='item')
-        local_desitnation = _get_local_download_destination(
-            os.path.basename(midas_item), sync_setting.local_root_dir, 
-            type='item', root_folder_id=sync_setting.midas_root_folder_id)
-        pydas.download(pydas_download_source, local_path=local_desitnation)
+        size = sync_status.midas_item_sizes.get(os.path.basename(midas_item), 0)
+        scheduler.add(size, midas_item, _download_only_midas_item, sync_setting,
+                      midas_item, size, content_index, progress, journal)
+    scheduler.run(progress)
 
     # process 'needs_update' data
     if sync_status.needs_update['files']:
-        agree_to_overwrite = _query_yes_no("Some local files are different with corresponding items in Midas. "  \
+        agree_to_overwrite = _query_yes_no_paused(progress,
+            "Some local files are different with corresponding items in Midas. "  \
             "Do you want to overwrite your local copy with the Midas copy (this operation cannot be undo)?")
         if agree_to_overwrite:
             for file in sync_status.needs_update['files']:
-                os.remove(file['filepath'])
-                pydas_download_source = _get_pydas_resource_path(
-                    file['midas_item_id'], type='item')
-                pydas.download(pydas_download_source, os.path.dirname(file['filepath']))
+                size = sync_status.midas_item_sizes.get(file['midas_item_id'], 0)
+                scheduler.add(size, file['filepath'], _overwrite_local_file,
+                              file, size, content_index, progress, journal)
+            scheduler.run(progress)
+    progress.end_phase()
 
     # process 'only_local' data
     if sync_status.only_local['entire_dirs'] or sync_status.only_local['files']:
-        agree_to_delete = _query_yes_no("Some directories and/or files only exist in your local disk. "  \
+        agree_to_delete = _query_yes_no_paused(progress,
+            "Some directories and/or files only exist in your local disk. "  \
             "Do you want to delete them (delete operation cannot be undo)?")
         if agree_to_delete:
             for dir in sync_status.only_local['entire_dirs']:
                 shutil.rmtree(dir)
+                journal.record('dir_removed', target=dir)
             for file in sync_status.only_local['files']:
                 os.remove(file['filepath'])
+                journal.record('file_removed', target=file['filepath'])
     print ("Data in %s has been mirrored(downloaded) to %s.\n" \
             % (os.path.join(sync_setting.midas_url, 'folder',
             sync_setting.midas_root_folder_id), sync_setting.local_root_dir))
 
 
+def _drop_missing_local_paths(sync_setting, sync_status):
+    """
+    Helper function to drop the operations of a replayed plan whose local
+    files or directories were removed after the run was interrupted
+    """
+    missing = [ ]
+    def exists(path):
+        if os.path.exists(path):
+            return True
+        missing.append(path)
+        return False
+    sync_status.only_local['entire_dirs'] = [dir for dir in
+        sync_status.only_local['entire_dirs'] if exists(dir)]
+    sync_status.only_local['files'] = [file for file in
+        sync_status.only_local['files'] if exists(file['filepath'])]
+    if sync_setting.mode == 'upload':
+        # a download removes the local file before overwriting it
+        sync_status.needs_update['files'] = [file for file in
+            sync_status.needs_update['files'] if exists(file['filepath'])]
+    sync_status.moves['folders'] = [move for move in
+        sync_status.moves['folders'] if exists(move['dirpath'])]
+    sync_status.moves['items'] = [move for move in
+        sync_status.moves['items'] if exists(move['filepath'])]
+    for path in missing:
+        print "Skipping %s which no longer exists." % path
+
+
+def _resume_from_journal(sync_setting, journal):
+    """
+    Helper function to rebuild the remaining synchronization status from the
+    journal of an interrupted run, and to clean up the half done operations.
+    Return None if there is nothing to resume.
+    """
+    records = journal.load()
+    if not records or records[0]['op'] != 'plan':
+        return None
+    if records[0]['mode'] != sync_setting.mode:
+        print ("Ignoring the journal %s of an interrupted %s run." \
+               % (journal.journal_file, records[0]['mode']))
+        return None
+    print ("Resuming the interrupted %s run from the journal %s." \
+           % (sync_setting.mode, journal.journal_file))
+    sync_status = SyncStatusDict.from_dict(records[0]['sync_status'])
+    if [record for record in records if record['op'] == 'moves_cancelled']:
+        _cancel_moves(sync_status)
+    done = set()
+    started = { }
+    created_folder_ids = { }
+    for record in records[1:]:
+        if record['op'] in ('item_created', 'dir_upload_started', 'folder_download_started'):
+            started[record['target']] = record
+        else:
+            done.add(record['target'])
+        if record['op'] == 'folder_created':
+            created_folder_ids[record['target']] = record['folder_id']
+    # clean up the orphans of the operations which never completed
+    for target, record in started.iteritems():
+        if target in done:
+            continue
+        if record['op'] == 'item_created':
+            print "Deleting the incomplete item %s in Midas" % record['item_id']
+            pydas.session.communicator.delete_item(pydas.session.token, record['item_id'])
+        elif record['op'] == 'dir_upload_started' and record['parent_folder_id'] is not None:
+            children = pydas.session.communicator.folder_children(
+                pydas.session.token, record['parent_folder_id'])
+            for midas_folder in children.get('folders', [ ]):
+                if midas_folder['name'] == os.path.basename(target):
+                    print "Deleting the incomplete folder %s in Midas" % midas_folder['folder_id']
+                    pydas.session.communicator.delete_folder(
+                        pydas.session.token, midas_folder['folder_id'])
+        elif record['op'] == 'folder_download_started' \
+            and os.path.isdir(record['local_path']):
+            print "Deleting the incomplete directory %s" % record['local_path']
+            shutil.rmtree(record['local_path'])
+    if sync_setting.rescan:
+        print "Discarding the plan of the interrupted run, checking the status again."
+        return None
+    journal.resume()
+    # only keep the operations which are not done yet
+    sync_status.only_local['entire_dirs'] = [dir for dir in
+        sync_status.only_local['entire_dirs'] if dir not in done]
+    sync_status.only_local['files'] = [file for file in
+        sync_status.only_local['files'] if file['filepath'] not in done]
+    sync_status.only_midas['entire_folders'] = [folder for folder in
+        sync_status.only_midas['entire_folders'] if folder not in done]
+    sync_status.only_midas['items'] = [item for item in
+        sync_status.only_midas['items'] if item not in done]
+    sync_status.needs_update['files'] = [file for file in
+        sync_status.needs_update['files'] if file['filepath'] not in done]
+    sync_status.moves['folders'] = [move for move in
+        sync_status.moves['folders'] if move['dirpath'] not in done]
+    sync_status.moves['items'] = [move for move in
+        sync_status.moves['items'] if move['filepath'] not in done]
+    sync_status.moves['new_folders'] = [new_folder for new_folder in
+        sync_status.moves['new_folders'] if new_folder['dirpath'] not in done]
+    _resolve_new_folders(sync_status, created_folder_ids)
+    _drop_missing_local_paths(sync_setting, sync_status)
+    sync_status.pprint()
+    return sync_status
+
+
 def synchronize_data(sync_setting):
     """
-    Recursively synchronize data between a local directory and a Midas folder
+    Recursively synchronize data between a local directory and a Midas folder.
+    Return False if some transfers failed.
     """
-    sync_done, sync_status = check_sync_status(sync_setting)
-    if sync_done:
-        return
-    if sync_setting.mode == "upload":
-        mirror_data_to_midas(sync_setting, sync_status)
-        check_sync_status(sync_setting)
-    elif sync_setting.mode == "download":
-        download_data_to_local(sync_setting, sync_status)
-        check_sync_status(sync_setting)
+    progress = SyncProgress(report_interval=sync_setting.stats_interval)
+    progress.start_reporting()
+    journal = SyncJournal(sync_setting.journal_file)
+    try:
+        sync_status = None
+        if sync_setting.mode in ("upload", "download"):
+            sync_status = _resume_from_journal(sync_setting, journal)
+        if sync_status is None:
+            progress.start_phase('scan')
+            sync_done, sync_status = check_sync_status(sync_setting, progress)
+            if sync_done or sync_setting.mode not in ("upload", "download"):
+                if sync_setting.rescan:
+                    journal.discard()
+                return True
+            journal.start(sync_setting.mode, sync_status)
+        if sync_setting.mode == "upload":
+            mirror_data_to_midas(sync_setting, sync_status, progress, journal)
+        elif sync_setting.mode == "download":
+            download_data_to_local(sync_setting, sync_status, progress, journal)
+        journal.finish()
+        progress.start_phase('verify')
+        check_sync_status(sync_setting, progress)
+        return True
+    except TransferError, e:
+        # keep the journal, the next run resumes the failed transfers
+        print "Caught a transfer error: %s" % e.msg
+        return False
+    finally:
+        progress.stop_reporting()
 
      
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hm:l:u:e:a:f:", 
-            ["help", "mode=", "localdir=", "url=", "email=", "apikey=", "folderid=" ])
+        opts, args = getopt.getopt(sys.argv[1:], "hm:l:u:e:a:f:t:j:s:r:", 
+            ["help", "mode=", "localdir=", "url=", "email=", "apikey=", "folderid=",
+             "statsinterval=", "journal=", "shard=", "shardby=", "report=", "reuse=",
+             "largefile=", "largelanes=", "smalllanes=", "rescan" ])
     except getopt.error, msg:
         raise Usage(msg)
 
@@ -480,11 +1701,26 @@ def main():
     midas_user_email = None
     midas_apikey = None
     midas_root_folder_id = None
+    stats_interval = 10
+    journal_file = None
+    shard = None
+    shard_by = 'topdir'
+    report_file = None
+    reuse = None
+    large_file_size = 1024
+    large_lanes = 2
+    small_lanes = 8
+    rescan = False
 
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             print "mSync.py [-m (check|upload|download)] -l <local_directory_path> " \
-                "-u <midas_url> -e <midas_user_email>  -a <midas_api_key> -f <midas_folder_id>"
+                "-u <midas_url> -e <midas_user_email>  -a <midas_api_key> -f <midas_folder_id> " \
+                "[-t <stats_interval_seconds>] [-j <journal_file_path> [--rescan]] " \
+                "[-s <shard_index>/<shard_count> [--shardby=(topdir|path)]] [-r <report_file_path>] " \
+                "[--reuse=(copy|hardlink|reflink)] [--largefile=<large_file_size_in_MB>] " \
+                "[--largelanes=<number_of_large_lanes>] [--smalllanes=<number_of_small_lanes>]"
+            print "mSync.py -m merge <report_file_path> [<report_file_path> ...]"
             sys.exit()
         elif opt in ('-m', '--mode'):
             mode = arg.lower()
@@ -498,6 +1734,37 @@ def main():
             midas_apikey = arg
         elif opt in ("-f", "--folderid"):
             midas_root_folder_id = arg
+        elif opt in ("-t", "--statsinterval"):
+            stats_interval = arg
+        elif opt in ("-j", "--journal"):
+            journal_file = os.path.abspath(arg)
+        elif opt in ("-s", "--shard"):
+            shard = arg
+        elif opt == "--shardby":
+            shard_by = arg.lower()
+        elif opt in ("-r", "--report"):
+            report_file = os.path.abspath(arg)
+        elif opt == "--reuse":
+            reuse = arg.lower()
+        elif opt == "--largefile":
+            large_file_size = arg
+        elif opt == "--largelanes":
+            large_lanes = arg
+        elif opt == "--smalllanes":
+            small_lanes = arg
+        elif opt == "--rescan":
+            rescan = True
+
+    # merge the reports of sharded runs
+    if mode.lower() == 'merge':
+        if not args:
+            print "Caught a sanity check error: no report file to merge!"
+            print "mSync.py --help for more information"
+            sys.exit()
+        sync_done, merged_status = merge_sync_reports(args)
+        if merged_status is None:
+            return 1
+        return
 
     # sanity check for input parameters
     for param in [local_root_dir, midas_url, midas_user_email, midas_apikey, 
@@ -506,16 +1773,48 @@ def main():
             print "Caught a sanity check error: At least one required parameter is missing!"
             print "mSync.py --help for more information"
             sys.exit()
+    if not str(stats_interval).isdigit():
+        print "Caught a sanity check error: stats interval must be a non-negative integer!"
+        sys.exit()
+    if shard is not None:
+        shard_index, _, shard_count = shard.partition('/')
+        if not shard_index.isdigit() or not shard_count.isdigit() \
+            or int(shard_index) >= int(shard_count):
+            print ("Caught a sanity check error: shard must be <shard_index>/<shard_count> " \
+                   "with 0 <= shard_index < shard_count!")
+            sys.exit()
+        shard = (int(shard_index), int(shard_count))
+    if shard_by not in ('topdir', 'path'):
+        print "Caught a sanity check error: shards can only be split by topdir or path!"
+        sys.exit()
+    if reuse not in (None, 'copy', 'hardlink', 'reflink'):
+        print "Caught a sanity check error: local files can only be reused by copy, " \
+            "hardlink or reflink!"
+        sys.exit()
+    for param in [large_file_size, large_lanes, small_lanes]:
+        if not str(param).isdigit() or int(param) < 1:
+            print "Caught a sanity check error: large file size and numbers of lanes " \
+                "must be positive integers!"
+            sys.exit()
     mode = mode.lower()
     midas_url = midas_url.rstrip('/')
     local_root_dir = os.path.abspath(local_root_dir)
+    if journal_file is None:
+        # one journal per (local directory, Midas folder, shard)
+        journal_file = os.path.join(os.path.expanduser('~'), '.msync', 'journal_%s.jsonl' \
+            % hashlib.md5('%s|%s|%s|%s|%s' % (local_root_dir, midas_url,
+                          midas_root_folder_id, shard, shard_by)).hexdigest())
     sync_setting = SyncSetting(mode, local_root_dir, midas_url, midas_apikey, 
-        midas_user_email, midas_root_folder_id)
+        midas_user_email, midas_root_folder_id, int(stats_interval), journal_file,
+        shard, shard_by, report_file, reuse, int(large_file_size) * 1024 * 1024,
+        int(large_lanes), int(small_lanes), rescan)
     input_sanity = sanity_check(sync_setting)
     
     # synchronize data
     if input_sanity:
-        synchronize_data(sync_setting)
+        if not synchronize_data(sync_setting):
+            # a non-zero exit status for the scripts running (sharded) synchronizations
+            return 1
             
 
 if __name__ == "__main__":
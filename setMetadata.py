@@ -29,10 +29,16 @@ setMataData: A helper script to set metadata by reading an excel file.
 
 import os
 import sys
+import csv
+import codecs
+import json
+import hashlib
 import getopt
 import shutil
 import datetime
 import pprint
+import threading
+import Queue
 import pydas
 import openpyxl
         
@@ -41,23 +47,146 @@ class MidasSetting(object):
     Class for Pydas login setting
     """
     def __init__(self, midas_url, midas_apikey, 
-                 midas_user_email, midas_root_folder_id):
+                 midas_user_email, midas_root_folder_id, num_workers=4):
         self.midas_url = midas_url
         self.midas_apikey = midas_apikey
         self.midas_user_email = midas_user_email
         self.midas_root_folder_id = midas_root_folder_id
+        self.num_workers = num_workers
 
    
+# metadata source file extension -> file format
+SUPPORTED_FILE_FORMATS = {'.xls': 'excel', '.xlsx': 'excel',
+                          '.csv': 'csv', '.tsv': 'tsv'}
+
+
 class ExcelSetting(object):
     """
     Class for excel source file setting setting
     """
-    def __init__(self, excel_file, excel_sheet_name,
-                 excel_max_columns, excel_max_rows):
+    def __init__(self, excel_file, excel_sheet_name, cache_file=None):
         self.excel_file = excel_file
         self.excel_sheet_name = excel_sheet_name
-        self.excel_max_columns = excel_max_columns
-        self.excel_max_rows = excel_max_rows
+        self.cache_file = cache_file
+        self.file_format = SUPPORTED_FILE_FORMATS.get(
+            os.path.splitext(excel_file)[1].lower())
+
+
+class MetadataCache(object):
+    """
+    Class for the fingerprints of the metadata applied by previous runs.
+    A fingerprint is [row hash, item update time]; an item whose fingerprint
+    still matches does not need to be checked against Midas again.
+    """
+    def __init__(self, cache_file, midas_url, midas_root_folder_id):
+        self.cache_file = cache_file
+        self.midas_url = midas_url
+        self.midas_root_folder_id = midas_root_folder_id
+        self.lock = threading.Lock()
+        self.fingerprints = { }
+        if cache_file is not None and os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'r') as f:
+                    cache = json.load(f)
+            except ValueError:
+                print "The metadata cache file %s is corrupted and is ignored." % cache_file
+                return
+            # the cache is only valid for the same Midas folder
+            if cache.get('midas_url') == midas_url \
+                and cache.get('midas_root_folder_id') == midas_root_folder_id:
+                self.fingerprints = cache.get('items', { })
+
+    def is_unchanged(self, item_id, fingerprint):
+        with self.lock:
+            return self.fingerprints.get(item_id) == fingerprint
+
+    def update(self, item_id, fingerprint):
+        with self.lock:
+            self.fingerprints[item_id] = fingerprint
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        with self.lock:
+            cache = {'midas_url': self.midas_url,
+                     'midas_root_folder_id': self.midas_root_folder_id,
+                     'items': self.fingerprints}
+            # write to a temporary file first so that an interrupted run
+            # never leaves a truncated cache behind
+            temp_file = self.cache_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(cache, f)
+            # rename replaces the cache atomically, except on Windows where
+            # it cannot overwrite an existing file
+            if os.name == 'nt' and os.path.exists(self.cache_file):
+                os.remove(self.cache_file)
+            os.rename(temp_file, self.cache_file)
+
+
+class MetadataProgress(object):
+    """
+    Class for thread-safe progress reporting while setting metadata.
+    Items are counted as they are discovered, so the total keeps growing
+    until the folder crawl is finished.
+    """
+    def __init__(self, report_every=100):
+        self.lock = threading.Lock()
+        self.report_every = report_every
+        self.discovered = 0
+        self.seen_item_ids = set()
+        self.crawl_finished = False
+        self.processed = 0
+        self.counts = {'updated': 0, 'up_to_date': 0, 'unchanged': 0,
+                       'skipped': 0, 'failed': 0}
+        self.failed_items = { }
+        self.failed_folders = { }
+
+    def log(self, message):
+        with self.lock:
+            print message
+
+    def add_items(self, items):
+        # an item may be listed in more than one folder, it is only returned
+        # the first time it is found
+        with self.lock:
+            new_items = [item for item in items
+                         if item['item_id'] not in self.seen_item_ids]
+            self.seen_item_ids.update(item['item_id'] for item in new_items)
+            self.discovered += len(new_items)
+        return new_items
+
+    def folder_failed(self, folder_id, detail):
+        with self.lock:
+            self.failed_folders[folder_id] = str(detail)
+
+    def finish_crawl(self):
+        with self.lock:
+            self.crawl_finished = True
+
+    def record(self, status, item_info=None, detail=None):
+        with self.lock:
+            self.processed += 1
+            self.counts[status] += 1
+            if status == 'failed':
+                self.failed_items[item_info['item_id']] = {
+                    'name': item_info['name'], 'error': str(detail)}
+            if self.processed % self.report_every == 0:
+                print ("Progress: %d/%d%s items processed (%d updated, %d up to date, " \
+                       "%d unchanged since last run, %d skipped, %d failed)." % (
+                       self.processed, self.discovered,
+                       '' if self.crawl_finished else '+',
+                       self.counts['updated'], self.counts['up_to_date'],
+                       self.counts['unchanged'], self.counts['skipped'],
+                       self.counts['failed']))
+
+    def pprint(self):
+        pp = pprint.PrettyPrinter(indent = 2)
+        print ("Metadata setting summary is as below: ")
+        pp.pprint({"discovered_items": self.discovered,
+                   "counts": self.counts,
+                   "failed_items": self.failed_items,
+                   "failed_folders": self.failed_folders})
+
 
 class Usage(Exception):
     def __init__(self, msg):
@@ -154,9 +283,9 @@ def sanity_check(midas_setting, excel_setting):
         print ("Caught a sanity check error: Metadata source file %s does not exist!" \
               % excel_setting.excel_file)
         return False
-    elif os.path.splitext(excel_setting.excel_file)[1] not in ['.xls', '.xlsx']:
-        print ("Caught a sanity check error: Metadata source file %s is not an excel file!" \
-                % excel_setting.excel_file)
+    elif excel_setting.file_format is None:
+        print ("Caught a sanity check error: Metadata source file %s is not an excel, " \
+               "CSV or TSV file!" % excel_setting.excel_file)
         return False      
     try:      
         pydas.login(email=midas_setting.midas_user_email, 
@@ -186,7 +315,11 @@ def _how_to_read_metadata(metadata_names):
     scan_number_col_id = None
     age_at_scan_col_ids = []
     for idx, name in enumerate(metadata_names):
-        if (name == 'Scan No.'):
+        if name is None:
+            print ("Caught a sanity check error: column %d has no name, " \
+                   "empty columns are not allowed!" % (idx + 1))
+            return False
+        elif (name == 'Scan No.'):
     # Note: excel uses 1-based index and python list use 0-based index
             scan_number_col_id = idx + 1
         elif (name == "Age @ Scan"):
@@ -200,66 +333,127 @@ def _how_to_read_metadata(metadata_names):
     metadata_structure['age_at_scan_col_ids'] = age_at_scan_col_ids
     metadata_structure['metadata_groups'] = {}
     #  metadata_structure['metadata_groups'] is defined as below
-    #  scan_number_col_id -> age_at_group_id -> [column_ids]
-    # E.g. metadata_structure['metadata_groups'] =
+    #  age_at_scan_col_id -> [column_ids]
+    # E.g. for 3 common columns and 5 groups of 3 columns
+    #  metadata_structure['metadata_groups'] =
     #         { 4: [1, 2, 3, 4, 5, 6],
     #           7: [1, 2, 3, 7, 8, 9],
     #          10: [1, 2, 3, 10, 11, 12],
     #          13: [1, 2, 3, 13, 14, 15],
     #          16: [1, 2, 3, 16, 17, 18]}
-    # Hack, manually set data structure for now
-    metadata_structure['metadata_groups'][4] =  [1, 2, 3, 4, 5, 6]
-    metadata_structure['metadata_groups'][7] =  [1, 2, 3, 7, 8, 9]
-    metadata_structure['metadata_groups'][10] = [1, 2, 3, 10, 11, 12]
-    metadata_structure['metadata_groups'][13] = [1, 2, 3, 13, 14, 15]
-    metadata_structure['metadata_groups'][16] = [1, 2, 3, 16, 17, 18]
+    common_col_ids = range(1, age_at_scan_col_ids[0])
+    group_ends = age_at_scan_col_ids[1:] + [len(metadata_names) + 1]
+    for age_at_scan_col_id, group_end in zip(age_at_scan_col_ids, group_ends):
+        metadata_structure['metadata_groups'][age_at_scan_col_id] = \
+            common_col_ids + range(age_at_scan_col_id, group_end)
     return metadata_structure
 
+def _iter_excel_rows(excel_setting):
+    """
+    Helper generator to stream the rows of an excel sheet as lists of values.
+    The workbook is opened in read-only mode, so memory stays bounded however
+    many rows the sheet holds.
+    """
+    wb = openpyxl.load_workbook(filename = excel_setting.excel_file,
+                                read_only=True, data_only=True)
+    try:
+        sheet = wb.active
+        if (excel_setting.excel_sheet_name is not None):
+            sheet = wb[excel_setting.excel_sheet_name]
+        # the stored dimension may be wrong, read the whole used range instead
+        if hasattr(sheet, 'reset_dimensions'):
+            sheet.reset_dimensions()
+        else:
+            # openpyxl before 2.6
+            sheet.max_row = sheet.max_column = None
+        for row in sheet.iter_rows():
+            yield [cell.value for cell in row]
+    finally:
+        wb.close()
+
+
+def _iter_delimited_rows(excel_setting):
+    """
+    Helper generator to stream the rows of a CSV/TSV file as lists of values.
+    Empty fields are returned as None, the same as empty excel cells.
+    """
+    delimiter = '\t' if excel_setting.file_format == 'tsv' else ','
+    with open(excel_setting.excel_file, 'rb') as f:
+        for row_number, row in enumerate(csv.reader(f, delimiter=delimiter)):
+            # strip the UTF-8 byte order mark of Excel "CSV UTF-8" exports
+            if row_number == 0 and row and row[0].startswith(codecs.BOM_UTF8):
+                row[0] = row[0][len(codecs.BOM_UTF8):]
+            yield [value if value != '' else None for value in row]
+
+
+def _format_cell_value(value):
+    """
+    Helper function to convert a cell value to the string stored in Midas.
+    """
+    if (type(value) is datetime.date) or (type(value) is datetime.datetime):
+        value = value.strftime("%b %d, %Y")
+    return str(value)
+
+
+def _normalize_scan_number(value):
+    """
+    Helper function to get the scan number of a row as int, which is how item
+    names are parsed. CSV/TSV cells are always strings, and excel may store
+    numbers as float.
+    """
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, basestring) and value.strip().isdigit():
+        return int(value)
+    return value
+
+
 def _get_metadata_from_excel(excel_setting):
     """
-    Read an excel file to get all the metadata.
+    Read an excel (or CSV/TSV) file to get all the metadata.
     """
-    print "\nStart parsing metadata from the sheet %s in the excel file %s." % (
-        excel_setting.excel_sheet_name, excel_setting.excel_file)
-    wb = openpyxl.load_workbook(filename = excel_setting.excel_file)
-    sheet = wb.active
-    if (excel_setting.excel_sheet_name is not None):
-        sheet = wb[excel_setting.excel_sheet_name]
+    if excel_setting.file_format == 'excel':
+        print "\nStart parsing metadata from the sheet %s in the excel file %s." % (
+            excel_setting.excel_sheet_name, excel_setting.excel_file)
+        rows = _iter_excel_rows(excel_setting)
+    else:
+        print "\nStart parsing metadata from the %s file %s." % (
+            excel_setting.file_format.upper(), excel_setting.excel_file)
+        rows = _iter_delimited_rows(excel_setting)
     # Assumption: metadata names are defined in the first row
-    metadata_names = []
-    main_row = 1
-    for col_idx in xrange(1, excel_setting.excel_max_columns):
-         col = openpyxl.cell.get_column_letter(col_idx)
-         name = sheet['%s%s'%(col, main_row)].value
-         if name is not None:
-            metadata_names.append(name)
+    try:
+        header = rows.next()
+    except StopIteration:
+        print ("We didn't get any metadata from the file %s, is it empty?" \
+               % excel_setting.excel_file)
+        return False
+    # drop the undefined columns at the end
+    metadata_names = header
+    while metadata_names and metadata_names[-1] is None:
+        metadata_names.pop()
     excel_structure = _how_to_read_metadata(metadata_names)
     if not excel_structure:
         return False
+    num_columns = len(metadata_names)
+    # metadata_dict is indexed as (scan_number, age_at_scan) -> {element: value}
     metadata_dict = {}
-    for row in xrange(main_row + 1, excel_setting.excel_max_rows):
+    for row in rows:
         # Assumption: the row is not empty if its first column has value
-        if sheet['%s%s'%('A', row)].value is None:
+        if not row or row[0] is None:
             continue
-        scan_number_col = openpyxl.cell.get_column_letter(excel_structure['scan_number_col_id'])
-        scan_number = sheet['%s%s'%(scan_number_col, row)].value
-        if not scan_number in metadata_dict.keys():
-            metadata_dict[scan_number] = {}
+        if len(row) < num_columns:
+            row.extend([None] * (num_columns - len(row)))
+        # Note: excel uses 1-based index and python list use 0-based index
+        scan_number = _normalize_scan_number(row[excel_structure['scan_number_col_id'] - 1])
         for age_at_scan_col_id in excel_structure['age_at_scan_col_ids']:
-            age_at_scan_col = openpyxl.cell.get_column_letter(age_at_scan_col_id)       
-            age_at_scan = sheet['%s%s'%(age_at_scan_col, row)].value
-            if not age_at_scan in metadata_dict[scan_number]:
-                metadata_dict[scan_number][age_at_scan] = {}
+            age_at_scan = row[age_at_scan_col_id - 1]
+            metadata = metadata_dict.setdefault((scan_number, age_at_scan), {})
             for col_id in excel_structure['metadata_groups'][age_at_scan_col_id]:
-                col = openpyxl.cell.get_column_letter(col_id)
-                # Note: excel uses 1-based index and python list use 0-based index
-                value = sheet['%s%s'%(col, row)].value
-                if (type(value) is datetime.date) or (type(value) is datetime.datetime):
-                    value = value.strftime("%b %d, %Y")
-                metadata_dict[scan_number][age_at_scan][metadata_names[col_id - 1]] = str(value)  
+                metadata[metadata_names[col_id - 1]] = _format_cell_value(row[col_id - 1])
     # Double check the data structure
     if not metadata_dict:
         print ("We didn't get any metadata from the excel file, is it empty?")
+        return False
     pp = pprint.PrettyPrinter(indent = 2)
     pp.pprint(metadata_dict.itervalues().next())
     agree_to_continue = _query_yes_no("A sample metadata group is displayed as above. "  \
@@ -270,6 +464,158 @@ def _get_metadata_from_excel(excel_setting):
         return metadata_dict                
 
 
+def _metadata_row_hash(metadata):
+    """
+    Helper function to calculate the md5 checksum of a metadata row
+    """
+    return hashlib.md5(json.dumps(metadata, sort_keys=True)).hexdigest()
+
+
+def _get_missing_metadata(metadata, metadata_info):
+    """
+    Helper function to get the (element, value) pairs of metadata that are
+    not yet set in metadata_info, the metadata list returned by Midas.
+    """
+    # index the existing metadata by element, an element may have several values
+    existing_metadata = {}
+    for existing in metadata_info:
+        existing_metadata.setdefault(existing['element'], set()).add(existing['value'])
+    return [(k, v) for k, v in metadata.iteritems()
+            if v not in existing_metadata.get(k, ())]
+
+
+def _set_item_metadata_batch(item_id, metadata_pairs):
+    """
+    Helper function to set several metadata fields of an item in one request.
+    pydas has no wrapper for this API method, so it is requested directly.
+    """
+    parameters = {'token': pydas.session.token, 'itemid': item_id,
+                  'count': len(metadata_pairs)}
+    for i, (element, value) in enumerate(metadata_pairs):
+        parameters['element_%d' % (i + 1)] = element
+        parameters['value_%d' % (i + 1)] = value
+    pydas.session.communicator.request('midas.item.setmultiplemetadata', parameters)
+
+
+def _set_metadata_for_item(item_info, metadata_lookup, metadata_cache, progress):
+    """
+    Helper function to set the missing metadata of an item in one request.
+    Return the status of the item: 'updated', 'up_to_date', 'unchanged'
+    or 'skipped'.
+    """
+    item_id = item_info['item_id']
+    temp_list = item_info['name'].split('_')
+    #Assumption: item is name as <scan_number>_<age_at_scan_month_number>months_<otherInformation> 
+    if len(temp_list) < 3 or not temp_list[1].endswith('months'):
+        progress.log("\nThe name of item %s (item id is %s) is not in " \
+            "<scan_number>_<age_at_scan_month_number>months_<otherInformation> format, " \
+            "and is skipped." % (item_info['name'], item_id))
+        return 'skipped'
+    scan_number = int(temp_list[0])
+    age_at_scan = temp_list[1]
+    metadata = metadata_lookup.get((scan_number, age_at_scan))
+    if metadata is None:
+        progress.log("\nCannot find the metadata for item %s (item id is %s)." \
+            % (item_info['name'], item_id))
+        return 'skipped'
+    fingerprint = [_metadata_row_hash(metadata), item_info.get('date_update')]
+    if metadata_cache.is_unchanged(item_id, fingerprint):
+        return 'unchanged'
+    metadata_info = pydas.session.communicator.get_item_metadata(item_id, pydas.session.token)
+    missing_metadata = _get_missing_metadata(metadata, metadata_info)
+    if not missing_metadata:
+        metadata_cache.update(item_id, fingerprint)
+        return 'up_to_date'
+    _set_item_metadata_batch(item_id, missing_metadata)
+    # setting metadata may touch the item's update time, keep the new one so
+    # that the next run skips this item
+    updated_item_info = pydas.session.communicator.item_get(pydas.session.token, item_id)
+    fingerprint[1] = updated_item_info.get('date_update')
+    metadata_cache.update(item_id, fingerprint)
+    progress.log("\nMetadata for item %s (item id is %s) is now set (%d fields updated)." \
+        % (item_info['name'], item_id, len(missing_metadata)))
+    return 'updated'
+
+
+def _metadata_worker(item_queue, metadata_lookup, metadata_cache, progress):
+    """
+    Worker thread to set metadata to the items taken from item_queue until
+    it gets None. A failure only affects the item being processed.
+    """
+    while True:
+        item_info = item_queue.get()
+        if item_info is None:
+            item_queue.task_done()
+            return
+        try:
+            status = _set_metadata_for_item(item_info, metadata_lookup,
+                                            metadata_cache, progress)
+            progress.record(status)
+        except Exception as detail:
+            progress.log("\nCaught an error when setting metadata for item %s " \
+                "(item id is %s): %s" % (item_info['name'], item_info['item_id'], detail))
+            progress.record('failed', item_info, detail)
+        item_queue.task_done()
+
+
+def _crawl_worker(folder_queue, item_queue, progress):
+    """
+    Worker thread to list the folders taken from folder_queue until it gets
+    None. Sub folders are put back to folder_queue and items are streamed
+    to item_queue as soon as they are found.
+    """
+    while True:
+        folder_id = folder_queue.get()
+        if folder_id is None:
+            folder_queue.task_done()
+            return
+        try:
+            for resource_type, resource_list in pydas.session.communicator.folder_children(
+              pydas.session.token, folder_id).iteritems():
+                if resource_type == 'folders':
+                    for midas_folder in resource_list:
+                        folder_queue.put(midas_folder['folder_id'])
+                elif resource_type == 'items':
+                    for midas_item in progress.add_items(resource_list):
+                        item_queue.put(midas_item)
+        except Exception as detail:
+            progress.log("\nCaught an error when listing folder %s: %s" % (folder_id, detail))
+            progress.folder_failed(folder_id, detail)
+        folder_queue.task_done()
+
+
+def _start_workers(target, args, num_workers):
+    """
+    Helper function to start a bounded pool of worker threads
+    """
+    workers = []
+    for i in xrange(num_workers):
+        worker = threading.Thread(target=target, args=args)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    return workers
+
+
+def _wait_for_threads(threads):
+    """
+    Helper function to wait until all the threads are finished
+    """
+    for thread in threads:
+        # join with a timeout so that Ctrl-C still interrupts the main thread
+        while thread.is_alive():
+            thread.join(1)
+
+
+def _stop_workers(work_queue, workers):
+    """
+    Helper function to wait until the workers drain work_queue
+    """
+    for worker in workers:
+        work_queue.put(None)
+    _wait_for_threads(workers)
+
+
 def set_matadata(midas_setting, excel_setting):
     """
     Set metadata to the items in Midas
@@ -279,52 +625,37 @@ def set_matadata(midas_setting, excel_setting):
     if not metadata_lookup:
         return False
     print "\nStart setting metadata to Midas."
-    # upload 'local_only' data to Midas
-    midas_folders_ids = []
-    midas_children_items = { }
-    midas_folders_ids.append(midas_setting.midas_root_folder_id)
-    print "\nCollecting items' information from Midas. It may take a couple of minutes. Please be patient!"
-    while midas_folders_ids:
-        folder_id = midas_folders_ids.pop(0)
-        for resource_type, resource_list in pydas.session.communicator.folder_children(
-          pydas.session.token, folder_id).iteritems():
-            if resource_type == 'folders':
-                for midas_folder in resource_list:
-                    midas_folders_ids.append(midas_folder['folder_id'])
-            elif resource_type == 'items':
-                for midas_item in resource_list:
-                    midas_children_items[midas_item['item_id']] = midas_item
-    metadata_info = []
-    temp_list = []  
-    for item_id, item_info in midas_children_items.iteritems():
-         metadata_info[:] = []
-         temp_list[:] = []
-         temp_list  = item_info['name'].split('_')
-         #Assumption: item is name as <scan_number>_<age_at_scan_month_number>months_<otherInformation> 
-         if len(temp_list) < 3 or not temp_list[1].endswith('months'):
-             print "\nThe name of item %s (item id is %s) is not in " \
-              "<scan_number>_<age_at_scan_month_number>months_<otherInformation> format, and is skipped." \
-               % (item_info['name'], item_id)
-             continue 
-         scan_number = int(temp_list[0])
-         age_at_scan = temp_list[1]
-         if (scan_number in metadata_lookup.keys() \
-           and age_at_scan in metadata_lookup[scan_number].keys()):
-             metadata_info = pydas.session.communicator.get_item_metadata(item_id, pydas.session.token)
-             for k, v in metadata_lookup[scan_number][age_at_scan].iteritems():
-                found = False
-                for metadata in metadata_info:
-                    if (metadata['element'] == k and metadata['value'] == v):
-                        found = True
-                        break
-                if not found:
-                    pydas.session.communicator.set_item_metadata(pydas.session.token, item_id, k, v)
-             print "\nMetadata for item %s (item id is %s) is now set (up to date)." \
-               % (item_info['name'], item_id)
-         else:
-             print "\nCannot find the metadata for item %s (item id is %s)." \
-               % (item_info['name'], item_id)
-    
+    print "\nCollecting items' information from Midas. Metadata are set as soon as items are found."
+    metadata_cache = MetadataCache(excel_setting.cache_file, midas_setting.midas_url,
+                                   midas_setting.midas_root_folder_id)
+    progress = MetadataProgress()
+    # folder_queue is unbounded since the crawlers both consume and feed it,
+    # item_queue is bounded so that the crawl cannot run far ahead
+    folder_queue = Queue.Queue()
+    item_queue = Queue.Queue(maxsize=midas_setting.num_workers * 4)
+    metadata_workers = _start_workers(_metadata_worker,
+        (item_queue, metadata_lookup, metadata_cache, progress),
+        midas_setting.num_workers)
+    crawl_workers = _start_workers(_crawl_worker,
+        (folder_queue, item_queue, progress), midas_setting.num_workers)
+    try:
+        folder_queue.put(midas_setting.midas_root_folder_id)
+        crawl_waiter = threading.Thread(target=folder_queue.join)
+        crawl_waiter.daemon = True
+        crawl_waiter.start()
+        _wait_for_threads([crawl_waiter])
+        progress.finish_crawl()
+        _stop_workers(folder_queue, crawl_workers)
+        _stop_workers(item_queue, metadata_workers)
+    finally:
+        # keep the fingerprints of the items done so far, even if interrupted
+        metadata_cache.save()
+    progress.pprint()
+    if progress.failed_items or progress.failed_folders:
+        print ("Failed to set metadata to %d items and to list %d folders, please " \
+               "run the script again to retry them." % (len(progress.failed_items),
+               len(progress.failed_folders)))
+        return False
     print ("MetaData in %s has been set to all the items in %s.\n" \
             % (excel_setting.excel_file, os.path.join(midas_setting.midas_url, 
                'folder', midas_setting.midas_root_folder_id)))
@@ -332,25 +663,28 @@ def set_matadata(midas_setting, excel_setting):
      
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hx:s:u:e:a:f:", 
-            ["help", "excelfile=", "sheetname=", "url=", "email=", "apikey=", "folderid=" ])
+        opts, args = getopt.getopt(sys.argv[1:], "hx:s:u:e:a:f:w:c:n", 
+            ["help", "excelfile=", "sheetname=", "url=", "email=", "apikey=", "folderid=",
+             "workers=", "cachefile=", "nocache" ])
     except getopt.error, msg:
         raise Usage(msg)
 
     # default setting
     excel_file = None
     excel_sheet_name = None
-    excel_max_columns = 30
-    excel_max_rows = 30
     midas_url = None
     midas_user_email = None
     midas_apikey = None
     midas_root_folder_id = None
+    num_workers = 4
+    cache_file = None
+    use_cache = True
 
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             print "setMetaData.py -x <metadata_excel_file_path> [-s <excel_sheet_name>]" \
-                "-u <midas_url> -e <midas_user_email>  -a <midas_api_key> -f <midas_folder_id>"
+                "-u <midas_url> -e <midas_user_email>  -a <midas_api_key> -f <midas_folder_id> " \
+                "[-w <number_of_workers>] [-c <metadata_cache_file_path> | -n]"
             sys.exit()
         elif opt in ("-x", "--excelfile"):
             excel_file = arg
@@ -364,6 +698,12 @@ def main():
             midas_apikey = arg
         elif opt in ("-f", "--folderid"):
             midas_root_folder_id = arg
+        elif opt in ("-w", "--workers"):
+            num_workers = arg
+        elif opt in ("-c", "--cachefile"):
+            cache_file = arg
+        elif opt in ("-n", "--nocache"):
+            use_cache = False
 
     # sanity check for input parameters
     for param in [excel_file, midas_url, midas_user_email, midas_apikey, 
@@ -372,17 +712,26 @@ def main():
             print "Caught a sanity check error: At least one required parameter is missing!"
             print "setMetadata.py --help for more information"
             sys.exit()
+    if not str(num_workers).isdigit() or int(num_workers) < 1:
+        print "Caught a sanity check error: number of workers must be a positive integer!"
+        sys.exit()
     midas_url = midas_url.rstrip('/')
     excel_file = os.path.abspath(excel_file)
+    if not use_cache:
+        cache_file = None
+    elif cache_file is None:
+        cache_file = os.path.splitext(excel_file)[0] + '.metadata_cache.json'
+    else:
+        cache_file = os.path.abspath(cache_file)
     midas_setting = MidasSetting(midas_url, midas_apikey, 
-        midas_user_email, midas_root_folder_id)
-    excel_setting = ExcelSetting(excel_file, excel_sheet_name,
-        excel_max_columns, excel_max_rows)
+        midas_user_email, midas_root_folder_id, int(num_workers))
+    excel_setting = ExcelSetting(excel_file, excel_sheet_name, cache_file)
     input_sanity = sanity_check(midas_setting, excel_setting)
     
     # set matadata
     if input_sanity:
-        set_matadata(midas_setting, excel_setting)
+        if not set_matadata(midas_setting, excel_setting):
+            return 1
             
 
 if __name__ == "__main__":